@@ -1,7 +1,9 @@
+import os
 import subprocess
 from pathlib import Path
 
 import pytest
+import torch
 
 
 @pytest.fixture(scope='session')
@@ -22,3 +24,21 @@ def build_docker_image_gpu(docker_image_name: str) -> str:
         ['docker', 'build', '-t', image_name, '-f', 'Dockerfile.gpu', '.'], check=True
     )
     return image_name
+
+
+def pytest_configure(config):
+    # Under pytest-xdist every worker runs its own torch, so split the cores between
+    # the workers instead of letting each one use all of them for intra-op threads
+    worker_count = os.environ.get('PYTEST_XDIST_WORKER_COUNT')
+    if worker_count:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // int(worker_count)))
+
+
+def pytest_collection_modifyitems(config, items):
+    if torch.cuda.is_available():
+        return
+    # Docker GPU tests run against the CUDA runtime inside the image, not the host torch
+    skip_gpu = pytest.mark.skip(reason='CUDA is not available')
+    for item in items:
+        if 'gpu' in item.keywords and 'docker' not in item.keywords:
+            item.add_marker(skip_gpu)
@@ -1,5 +1,7 @@
+import os
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, Tuple
 
 import clip
 import numpy as np
@@ -8,23 +10,143 @@ import torch
 from clip_image import CLIPImageEncoderCUDA11
 from jina import Document, DocumentArray, Executor
 from PIL import Image
+from torchvision.transforms import Compose, Normalize, ToTensor
 
 _EMBEDDING_DIM = 512
 
+# Documents only hold a reference to their tensor, so all tests share these
+# read-only constants instead of allocating a fresh array per Document.
+# ``np.broadcast_to`` returns a read-only view that needs no pixel storage at all
+_TENSOR_HWC_100 = np.broadcast_to(np.uint8(1), (100, 100, 3))
+_TENSOR_HWC_224 = np.ones((224, 224, 3), dtype=np.uint8)
+_TENSOR_HWC_224.setflags(write=False)
+_TENSOR_CHW_224_U8 = np.ones((3, 224, 224), dtype=np.uint8)
+_TENSOR_CHW_224_U8.setflags(write=False)
+_TENSOR_CHW_224_F32 = np.ones((3, 224, 224), dtype=np.float32)
+_TENSOR_CHW_224_F32.setflags(write=False)
+
+
+def _assert_same_embedding(actual: np.ndarray, desired: np.ndarray):
+    # Identical inputs normally give bitwise identical embeddings, so only pay for
+    # the tolerance-based comparison when the cheap exact check fails
+    if not np.array_equal(actual, desired):
+        np.testing.assert_allclose(actual, desired)
+
+
+@pytest.fixture(autouse=True)
+def _inference_mode():
+    with torch.inference_mode():
+        yield
+
+
+def _warmup(encoder: CLIPImageEncoderCUDA11) -> CLIPImageEncoderCUDA11:
+    """
+    Run a single dummy forward pass so that the cold-start cost (graph construction,
+    cuBLAS/cuDNN handles) is paid at fixture setup and not inside the first test.
+    ``encode`` copies the embeddings back to the host, which already synchronizes
+    the encoder's device
+    """
+    tensor = _TENSOR_HWC_224 if encoder.use_default_preprocessing else _TENSOR_CHW_224_F32
+    encoder.encode(DocumentArray([Document(tensor=tensor)]), {})
+    return encoder
+
+
+@pytest.fixture(scope="session")
+def encoder_cpu() -> CLIPImageEncoderCUDA11:
+    return _warmup(CLIPImageEncoderCUDA11(device="cpu"))
+
+
+@pytest.fixture(scope="session")
+def encoder_cpu_no_pre() -> CLIPImageEncoderCUDA11:
+    return _warmup(
+        CLIPImageEncoderCUDA11(device="cpu", use_default_preprocessing=False)
+    )
+
+
+@pytest.fixture(scope="session")
+def cuda_device() -> str:
+    """
+    CUDA device for this test process. Under ``pytest-xdist`` each worker
+    (``gw0``, ``gw1``, ...) gets its own GPU when more than one is available.
+    Only requested by ``gpu`` tests, which conftest skips when CUDA is unavailable
+    """
+    assert torch.cuda.is_available(), "cuda_device requires CUDA, mark the test with gpu"
+    worker = os.environ.get("PYTEST_XDIST_WORKER", "gw0")
+    return f"cuda:{int(worker[2:]) % torch.cuda.device_count()}"
+
+
+@pytest.fixture(scope="session")
+def encoder_cuda(cuda_device: str) -> CLIPImageEncoderCUDA11:
+    return _warmup(CLIPImageEncoderCUDA11(device=cuda_device))
+
+
+@pytest.fixture(scope="session")
+def encoder_cuda_no_pre(cuda_device: str) -> CLIPImageEncoderCUDA11:
+    return _warmup(
+        CLIPImageEncoderCUDA11(device=cuda_device, use_default_preprocessing=False)
+    )
+
+
+@pytest.fixture(scope="session")
+def encoder_openai_cpu(encoder_cpu: CLIPImageEncoderCUDA11) -> CLIPImageEncoderCUDA11:
+    # Default model is "openai/clip-vit-base-patch32" on cpu, so reuse the weights
+    return encoder_cpu
+
+
+@pytest.fixture(scope="session")
+def openai_clip():
+    return clip.load("ViT-B/32", device="cpu")
+
 
 @pytest.fixture(scope="module")
-def encoder() -> CLIPImageEncoderCUDA11:
-    return CLIPImageEncoderCUDA11()
+def encoder(encoder_cpu: CLIPImageEncoderCUDA11) -> CLIPImageEncoderCUDA11:
+    return encoder_cpu
 
 
 @pytest.fixture(scope="module")
-def encoder_no_pre() -> CLIPImageEncoderCUDA11:
-    return CLIPImageEncoderCUDA11(use_default_preprocessing=False)
+def encoder_no_pre(encoder_cpu_no_pre: CLIPImageEncoderCUDA11) -> CLIPImageEncoderCUDA11:
+    return encoder_cpu_no_pre
 
 
-@pytest.fixture(scope="function")
-def nested_docs() -> DocumentArray:
-    tensor = np.ones((224, 224, 3), dtype=np.uint8)
+@pytest.fixture(scope="module")
+def loaded_executor() -> Executor:
+    return Executor.load_config(str(Path(__file__).parents[2] / 'config.yml'))
+
+
+@pytest.fixture(scope="session")
+def test_images() -> Dict[str, np.ndarray]:
+    data_dir = Path(__file__).parent.parent / "imgs"
+    return {
+        name: np.array(Image.open(data_dir / f"{name}.jpg"))
+        for name in ("dog", "cat", "airplane", "helicopter")
+    }
+
+
+@pytest.fixture(scope="module")
+def docs_32_small() -> DocumentArray:
+    return DocumentArray([Document(tensor=_TENSOR_HWC_100) for _ in range(32)])
+
+
+@pytest.fixture(scope="module")
+def docs_32_chw_224() -> DocumentArray:
+    return DocumentArray([Document(tensor=_TENSOR_CHW_224_U8) for _ in range(32)])
+
+
+def _reset(docs: DocumentArray) -> DocumentArray:
+    """
+    Clear, in place, the embeddings a previous test left on the module-scoped
+    ``docs`` and all of their (nested) chunks and return them. The Documents
+    themselves are reused, not copied
+    """
+    for doc in docs:
+        doc.embedding = None
+        _reset(doc.chunks)
+    return docs
+
+
+@pytest.fixture(scope="module")
+def nested_docs_template() -> DocumentArray:
+    tensor = _TENSOR_HWC_224
     docs = DocumentArray([Document(id="root1", tensor=tensor)])
     docs[0].chunks = [
         Document(id="chunk11", tensor=tensor),
@@ -39,9 +161,17 @@ def nested_docs() -> DocumentArray:
     return docs
 
 
-def test_config():
-    ex = Executor.load_config(str(Path(__file__).parents[2] / 'config.yml'))
-    assert ex.batch_size == 32
+@pytest.fixture(scope="function")
+def nested_docs(nested_docs_template: DocumentArray) -> DocumentArray:
+    return _reset(nested_docs_template)
+
+
+def test_shared_tensor_has_no_storage():
+    assert _TENSOR_HWC_100.strides == (0, 0, 0)
+
+
+def test_config(loaded_executor: Executor):
+    assert loaded_executor.batch_size == 32
 
 
 def test_no_documents(encoder: CLIPImageEncoderCUDA11):
@@ -57,7 +187,7 @@ def test_docs_no_tensors(encoder: CLIPImageEncoderCUDA11):
 
 
 def test_single_image(encoder: CLIPImageEncoderCUDA11):
-    docs = DocumentArray([Document(tensor=np.ones((100, 100, 3), dtype=np.uint8))])
+    docs = DocumentArray([Document(tensor=_TENSOR_HWC_100)])
     encoder.encode(docs, {})
 
     assert docs[0].embedding.shape == (_EMBEDDING_DIM,)
@@ -65,60 +195,56 @@ def test_single_image(encoder: CLIPImageEncoderCUDA11):
 
 
 def test_single_image_no_preprocessing(encoder_no_pre: CLIPImageEncoderCUDA11):
-    docs = DocumentArray([Document(tensor=np.ones((3, 224, 224), dtype=np.uint8))])
+    docs = DocumentArray([Document(tensor=_TENSOR_CHW_224_U8)])
     encoder_no_pre.encode(docs, {})
 
     assert docs[0].embedding.shape == (_EMBEDDING_DIM,)
     assert docs[0].embedding.dtype == np.float32
 
 
-def test_encoding_cpu():
-    encoder = CLIPImageEncoderCUDA11(device="cpu")
-    input_data = DocumentArray([Document(tensor=np.ones((100, 100, 3), dtype=np.uint8))])
+def test_encoding_cpu(encoder_cpu: CLIPImageEncoderCUDA11):
+    input_data = DocumentArray([Document(tensor=_TENSOR_HWC_100)])
 
-    encoder.encode(docs=input_data, parameters={})
+    encoder_cpu.encode(docs=input_data, parameters={})
 
     assert input_data[0].embedding.shape == (_EMBEDDING_DIM,)
 
 
-def test_cpu_no_preprocessing():
-    encoder = CLIPImageEncoderCUDA11(device="cpu", use_default_preprocessing=False)
-    input_data = DocumentArray([Document(tensor=np.ones((3, 224, 224), dtype=np.uint8))])
+def test_cpu_no_preprocessing(encoder_cpu_no_pre: CLIPImageEncoderCUDA11):
+    input_data = DocumentArray([Document(tensor=_TENSOR_CHW_224_U8)])
 
-    encoder.encode(docs=input_data, parameters={})
+    encoder_cpu_no_pre.encode(docs=input_data, parameters={})
 
     assert input_data[0].embedding.shape == (_EMBEDDING_DIM,)
 
 
 @pytest.mark.gpu
-def test_encoding_gpu():
-    encoder = CLIPImageEncoderCUDA11(device="cuda")
-    input_data = DocumentArray([Document(tensor=np.ones((100, 100, 3), dtype=np.uint8))])
+@pytest.mark.xdist_group("gpu")
+def test_encoding_gpu(encoder_cuda: CLIPImageEncoderCUDA11):
+    input_data = DocumentArray([Document(tensor=_TENSOR_HWC_100)])
 
-    encoder.encode(docs=input_data, parameters={})
+    encoder_cuda.encode(docs=input_data, parameters={})
 
     assert input_data[0].embedding.shape == (_EMBEDDING_DIM,)
 
 
 @pytest.mark.gpu
-def test_gpu_no_preprocessing():
-    encoder = CLIPImageEncoderCUDA11(device="cuda", use_default_preprocessing=False)
-    input_data = DocumentArray(
-        [Document(tensor=np.ones((3, 224, 224), dtype=np.float32))]
-    )
+@pytest.mark.xdist_group("gpu")
+def test_gpu_no_preprocessing(encoder_cuda_no_pre: CLIPImageEncoderCUDA11):
+    input_data = DocumentArray([Document(tensor=_TENSOR_CHW_224_F32)])
 
-    encoder.encode(docs=input_data, parameters={})
+    encoder_cuda_no_pre.encode(docs=input_data, parameters={})
 
     assert input_data[0].embedding.shape == (_EMBEDDING_DIM,)
 
 
 def test_clip_any_image_shape(encoder: CLIPImageEncoderCUDA11):
-    docs = DocumentArray([Document(tensor=np.ones((224, 224, 3), dtype=np.uint8))])
+    docs = DocumentArray([Document(tensor=_TENSOR_HWC_224)])
 
     encoder.encode(docs=docs, parameters={})
     assert len(docs.embeddings) == 1
 
-    docs = DocumentArray([Document(tensor=np.ones((100, 100, 3), dtype=np.uint8))])
+    docs = DocumentArray([Document(tensor=_TENSOR_HWC_100)])
     encoder.encode(docs=docs, parameters={})
     assert len(docs.embeddings) == 1
 
@@ -131,35 +257,36 @@ def test_clip_batch(encoder: CLIPImageEncoderCUDA11):
     """
     docs = DocumentArray(
         [
-            Document(tensor=np.ones((100, 100, 3), dtype=np.uint8)),
-            Document(tensor=np.ones((100, 100, 3), dtype=np.uint8)),
+            Document(tensor=_TENSOR_HWC_100),
+            Document(tensor=_TENSOR_HWC_100),
         ]
     )
     encoder.encode(docs, parameters={})
     assert len(docs.embeddings) == 2
     assert docs[0].embedding.shape == (_EMBEDDING_DIM,)
     assert docs[0].embedding.dtype == np.float32
-    np.testing.assert_allclose(docs[0].embedding, docs[1].embedding)
+    _assert_same_embedding(docs[0].embedding, docs[1].embedding)
 
 
 def test_batch_no_preprocessing(encoder_no_pre: CLIPImageEncoderCUDA11):
     docs = DocumentArray(
         [
-            Document(tensor=np.ones((3, 224, 224), dtype=np.float32)),
-            Document(tensor=np.ones((3, 224, 224), dtype=np.float32)),
+            Document(tensor=_TENSOR_CHW_224_F32),
+            Document(tensor=_TENSOR_CHW_224_F32),
         ]
     )
     encoder_no_pre.encode(docs, {})
     assert len(docs.embeddings) == 2
     assert docs[0].embedding.shape == (_EMBEDDING_DIM,)
     assert docs[0].embedding.dtype == np.float32
-    np.testing.assert_allclose(docs[0].embedding, docs[1].embedding)
+    _assert_same_embedding(docs[0].embedding, docs[1].embedding)
 
 
 @pytest.mark.parametrize("batch_size", [1, 2, 4, 8])
-def test_batch_size(encoder: CLIPImageEncoderCUDA11, batch_size: int):
-    tensor = np.ones((100, 100, 3), dtype=np.uint8)
-    docs = DocumentArray([Document(tensor=tensor) for _ in range(32)])
+def test_batch_size(
+    encoder: CLIPImageEncoderCUDA11, docs_32_small: DocumentArray, batch_size: int
+):
+    docs = _reset(docs_32_small)
     encoder.encode(docs, parameters={"batch_size": batch_size})
 
     for doc in docs:
@@ -167,33 +294,33 @@ def test_batch_size(encoder: CLIPImageEncoderCUDA11, batch_size: int):
 
 
 @pytest.mark.parametrize("batch_size", [1, 2, 4, 8])
-def test_batch_size_no_preprocessing(encoder_no_pre: CLIPImageEncoderCUDA11, batch_size: int):
-    tensor = np.ones((3, 224, 224), dtype=np.uint8)
-    docs = DocumentArray([Document(tensor=tensor) for _ in range(32)])
+def test_batch_size_no_preprocessing(
+    encoder_no_pre: CLIPImageEncoderCUDA11,
+    docs_32_chw_224: DocumentArray,
+    batch_size: int,
+):
+    docs = _reset(docs_32_chw_224)
     encoder_no_pre.encode(docs, parameters={"batch_size": batch_size})
 
     for doc in docs:
         assert doc.embedding.shape == (_EMBEDDING_DIM,)
 
 
-def test_embeddings_quality(encoder: CLIPImageEncoderCUDA11):
+def test_embeddings_quality(
+    encoder: CLIPImageEncoderCUDA11, test_images: Dict[str, np.ndarray]
+):
     """
     This tests that the embeddings actually "make sense".
     We check this by making sure that the distance between the embeddings
     of two similar images is smaller than everything else.
     """
 
-    data_dir = Path(__file__).parent.parent / "imgs"
-    dog = Document(id="dog", tensor=np.array(Image.open(data_dir / "dog.jpg")))
-    cat = Document(id="cat", tensor=np.array(Image.open(data_dir / "cat.jpg")))
-    airplane = Document(
-        id="airplane", tensor=np.array(Image.open(data_dir / "airplane.jpg"))
-    )
-    helicopter = Document(
-        id="helicopter", tensor=np.array(Image.open(data_dir / "helicopter.jpg"))
+    docs = DocumentArray(
+        [
+            Document(id=k, tensor=test_images[k])
+            for k in ("dog", "cat", "airplane", "helicopter")
+        ]
     )
-
-    docs = DocumentArray([dog, cat, airplane, helicopter])
     encoder.encode(docs, {})
 
     docs.match(docs)
@@ -202,32 +329,46 @@ def test_embeddings_quality(encoder: CLIPImageEncoderCUDA11):
         assert doc.matches[1].id == matches[i]
 
 
-def test_openai_embed_match():
-    data_dir = Path(__file__).parent.parent / "imgs"
-    dog = Document(id="dog", tensor=np.array(Image.open(data_dir / "dog.jpg")))
-    airplane = Document(
-        id="airplane", tensor=np.array(Image.open(data_dir / "airplane.jpg"))
-    )
-    helicopter = Document(
-        id="helicopter", tensor=np.array(Image.open(data_dir / "helicopter.jpg"))
+def test_openai_embed_match(
+    encoder_openai_cpu: CLIPImageEncoderCUDA11,
+    openai_clip,
+    test_images: Dict[str, np.ndarray],
+):
+    docs = DocumentArray(
+        [
+            Document(id=k, tensor=test_images[k])
+            for k in ("dog", "airplane", "helicopter")
+        ]
     )
 
-    docs = DocumentArray([dog, airplane, helicopter])
-
-    clip_text_encoder = CLIPImageEncoderCUDA11("openai/clip-vit-base-patch32", device="cpu")
-    clip_text_encoder.encode(docs, {})
+    encoder_openai_cpu.encode(docs, {})
 
     actual_embedding = np.stack(docs.embeddings)
 
     # assert same results with OpenAI's implementation
-    model, preprocess = clip.load("ViT-B/32", device="cpu")
+    model, preprocess = openai_clip
     tensors = [doc.tensor for doc in docs]
 
-    with torch.no_grad():
-        images = [Image.fromarray(tensor) for tensor in tensors]
-        tensors = [preprocess(img) for img in images]
-        tensor = torch.stack(tensors)
-        expected_embedding = model.encode_image(tensor).numpy()
+    # Only run the PIL resize/crop steps, ``ToTensor`` and ``Normalize`` are fused
+    # into a single in-place pass over the stacked batch below
+    *resize_transforms, to_tensor, normalize = preprocess.transforms
+    assert isinstance(to_tensor, ToTensor), f"unexpected CLIP transforms: {preprocess}"
+    assert isinstance(normalize, Normalize), f"unexpected CLIP transforms: {preprocess}"
+    resize = Compose(resize_transforms)
+    mean = torch.tensor(normalize.mean).view(-1, 1, 1)
+    std = torch.tensor(normalize.std).view(-1, 1, 1)
+
+    def _to_pixels(t: np.ndarray) -> torch.Tensor:
+        img = resize(Image.fromarray(t))
+        return torch.from_numpy(np.asarray(img, dtype=np.float32).transpose(2, 0, 1))
+
+    # PIL releases the GIL while resizing, so the images can be preprocessed in parallel
+    with ThreadPool(min(len(tensors), os.cpu_count() or 1)) as pool:
+        preprocessed = pool.map(_to_pixels, tensors)
+
+    # Runs under the autouse ``_inference_mode`` fixture
+    tensor = torch.stack(preprocessed).div_(255).sub_(mean).div_(std)
+    expected_embedding = model.encode_image(tensor).numpy()
 
     np.testing.assert_almost_equal(actual_embedding, expected_embedding, 5)
 